@@ -1,55 +1,259 @@
 import os
 import sys
 import json
-import fitz  # PyMuPDF
+import asyncio
+import hashlib
+import functools
+import inspect
+import multiprocessing
+import tempfile
 from dotenv import load_dotenv
-from crewai import Agent, Task, Crew
-from langchain_google_genai import ChatGoogleGenerativeAI
-from pdf2image import convert_from_path
-import pytesseract
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from types import SimpleNamespace
 from datetime import datetime
 import re
+import zlib
 
 # Load environment variables
 load_dotenv()
 
 # Step 1: Configure Gemini LLM
-try:
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash-preview-04-17",
+GEMINI_MODEL = "gemini-2.5-flash-preview-04-17"
+# Retries per Gemini call; LiteLLM backs off exponentially on 429/503 responses
+GEMINI_MAX_RETRIES = 6
+# Requests per minute allowed for the Gemini project, shared by every agent in the run
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+
+def create_llm():
+    """Create the Gemini LLM; CrewAI is imported here, on first use, not at module import."""
+    from crewai import LLM
+    return LLM(
+        model=f"gemini/{GEMINI_MODEL}",
         temperature=0,
-        google_api_key=os.getenv("GOOGLE_API_KEY")
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        num_retries=GEMINI_MAX_RETRIES,
+        retry_strategy="exponential_backoff_retry"
     )
-except Exception as e:
-    print(f"Error initializing Gemini LLM: {str(e)}")
-    sys.exit(1)
+
+@functools.lru_cache(maxsize=None)
+def gemini_rpm_controller():
+    """Create the run-wide request counter, so agents in concurrently running crews share GEMINI_RPM."""
+    from crewai.utilities import RPMController
+    return RPMController(max_rpm=GEMINI_RPM)
 
 # Step 2: Extract text from PDF with OCR fallback
-def extract_pdf_text(pdf_path):
-    """Extract text from a PDF using PyMuPDF, with OCR as a fallback."""
+# Tesseract engine owned by each OCR worker process, when the optional tesserocr package is installed
+_tess_api = None
+
+def _init_ocr_worker():
+    """Start a Tesseract engine once per worker so it is reused across pages, if tesserocr is available."""
+    global _tess_api
     try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            page_text = page.get_text()
-            if page_text:
-                text += page_text + "\n"
-        doc.close()
-        if text.strip():
-            return text
-        print("No text extracted with PyMuPDF, attempting OCR...")
-        images = convert_from_path(pdf_path)
-        ocr_text = ""
+        from tesserocr import PyTessBaseAPI
+    except ImportError:
+        return
+    _tess_api = PyTessBaseAPI()
+
+def _ocr_images(images):
+    """Run OCR on a batch of page images with the worker's Tesseract engine, or one pytesseract call without tesserocr."""
+    if _tess_api is not None:
+        texts = []
         for image in images:
-            ocr_text += pytesseract.image_to_string(image) + "\n"
-        return ocr_text if ocr_text.strip() else "No text extracted via OCR."
+            _tess_api.SetImage(image)
+            texts.append(_tess_api.GetUTF8Text())
+        return texts
+    import pytesseract
+    # A list file lets one tesseract process read the whole batch; it ends each page's text with a form feed
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_paths = []
+        for i, image in enumerate(images):
+            image_paths.append(os.path.join(tmp_dir, f"page_{i}.png"))
+            image.save(image_paths[-1])
+        list_file = os.path.join(tmp_dir, "pages.txt")
+        with open(list_file, 'w', encoding='utf-8') as f:
+            f.write("\n".join(image_paths) + "\n")
+        texts = pytesseract.image_to_string(list_file).split('\f')
+    return (texts + [''] * len(images))[:len(images)]
+
+# 150 DPI grayscale is enough for Tesseract on text pages and renders far fewer pixels than the 200 DPI RGB default
+OCR_DPI = 150
+# Pages each OCR worker renders and recognizes per job; small batches keep every worker busy
+# and let the first pages come back early, while Poppler and tesseract start once per batch rather than per page
+OCR_BATCH_PAGES = 4
+
+def _page_batches(page_nums, batch_pages=OCR_BATCH_PAGES):
+    """Group sorted 0-based page numbers into [first, last] runs of at most batch_pages consecutive pages."""
+    batches = []
+    for page_num in page_nums:
+        if batches and batches[-1][1] == page_num - 1 and page_num - batches[-1][0] < batch_pages:
+            batches[-1][1] = page_num
+        else:
+            batches.append([page_num, page_num])
+    return batches
+
+def _ocr_page_batch(pdf_path, batch):
+    """Render a run of consecutive pages inside the worker and OCR them as one batch."""
+    from pdf2image import convert_from_path
+    first, last = batch
+    images = convert_from_path(pdf_path, dpi=OCR_DPI, first_page=first + 1, last_page=last + 1,
+                               fmt='png', grayscale=True)
+    return _ocr_images(images)
+
+def _ocr_pdf_pages(pdf_path, page_nums):
+    """Render and OCR only the given 0-based pages in worker batches, yielding their text in page order."""
+    # Spawn rather than fork: the metadata crew's HTTP and timer threads may already be running by now
+    with ProcessPoolExecutor(initializer=_init_ocr_worker, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for texts in executor.map(functools.partial(_ocr_page_batch, pdf_path), _page_batches(page_nums)):
+            yield from texts
+
+# Running headers/footers: text blocks that repeat on at least this share of pages (margin blocks are
+# compared with digits masked, so "EP39 ... 12" and "EP39 ... 13" match), and bare page numbers in the margin band
+RUNNING_BLOCK_MIN_SHARE = 0.6
+MARGIN_BAND = 0.05
+_DIGITS_RE = re.compile(r'\d+')
+_PAGE_NUMBER_RE = re.compile(r'^\s*(page\s*)?[ivxlc\d]+(\s*(of|/)\s*\d+)?\s*$', re.IGNORECASE)
+
+def _page_text_blocks(page):
+    """Return a page's text blocks as (text, in_margin) pairs, in the order MuPDF stores them."""
+    import fitz  # PyMuPDF
+    height = page.rect.height
+    # Join words hyphenated across line breaks and expand ligatures; blocks are not sorted by position
+    flags = fitz.TEXT_DEHYPHENATE | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+    return [
+        (text, y0 < MARGIN_BAND * height or y1 > (1 - MARGIN_BAND) * height)
+        for x0, y0, x1, y1, text, block_no, block_type in page.get_text("blocks", flags=flags)
+        if block_type == 0
+    ]
+
+def _running_block_key(text, in_margin):
+    """Key used to spot a block repeated across pages."""
+    return _DIGITS_RE.sub('#', text.strip()) if in_margin else text.strip()
+
+def _strip_running_blocks(pages_blocks):
+    """Join each page's text blocks, dropping running headers/footers and margin page numbers."""
+    counts = Counter(key for blocks in pages_blocks for key in {_running_block_key(*block) for block in blocks})
+    min_count = max(3, RUNNING_BLOCK_MIN_SHARE * len(pages_blocks))
+    texts = []
+    for blocks in pages_blocks:
+        kept = [
+            text for text, in_margin in blocks
+            if counts[_running_block_key(text, in_margin)] < min_count
+            and not (in_margin and _PAGE_NUMBER_RE.match(text))
+        ]
+        texts.append("".join(text if text.endswith("\n") else text + "\n" for text in kept))
+    return texts
+
+class PartialPdfText(str):
+    """Text of a page, or a document, whose scanned content could not be OCR'd; it is not cached."""
+
+def iter_pdf_pages(pdf_path):
+    """Yield (page_num, text) for every page in order, OCR'ing scanned pages without a text layer."""
+    import fitz  # PyMuPDF
+    # Keep MuPDF warnings off stderr, which can block in sandboxed environments
+    fitz.TOOLS.mupdf_display_errors(False)
+    fitz.TOOLS.set_small_glyph_heights(False)
+    doc = fitz.open(pdf_path)
+    texts = _strip_running_blocks([_page_text_blocks(page) for page in doc])
+    # Only pages with an embedded image can hold scanned text; blank pages and pages left empty by
+    # header/footer stripping keep their PyMuPDF text
+    ocr_pages = [page_num for page_num, page_text in enumerate(texts)
+                 if not page_text.strip() and doc[page_num].get_images()]
+    doc.close()
+    ocr_texts = None
+    if ocr_pages:
+        print(f"No text extracted with PyMuPDF from {len(ocr_pages)} scanned page(s), attempting OCR...")
+        ocr_texts = _ocr_pdf_pages(pdf_path, ocr_pages)
+    ocr_page_set = set(ocr_pages)
+    for page_num, page_text in enumerate(texts):
+        if page_num in ocr_page_set and ocr_texts is not None:
+            try:
+                page_text = next(ocr_texts)
+            except Exception as e:
+                print(f"OCR failed, keeping PyMuPDF text for the remaining pages: {str(e)}")
+                ocr_texts = None
+        if page_num in ocr_page_set and ocr_texts is None:
+            page_text = PartialPdfText(page_text)
+        yield page_num, page_text
+
+# Extracted text is cached here, keyed by the PDF's content hash and the page-selection arguments.
+# Bump PDF_TEXT_CACHE_VERSION whenever a change to extraction alters its output.
+PDF_TEXT_CACHE_DIR = '.cache'
+PDF_TEXT_CACHE_VERSION = 5
+
+def disk_cache(extract):
+    """Cache a PDF text extractor's result on disk so re-runs skip PyMuPDF/OCR."""
+    signature = inspect.signature(extract)
+
+    @functools.wraps(extract)
+    def wrapper(pdf_path, *args, **kwargs):
+        bound = signature.bind(pdf_path, *args, **kwargs)
+        bound.apply_defaults()
+        try:
+            with open(pdf_path, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        except OSError:
+            return extract(pdf_path, *args, **kwargs)
+        # Keyword-only arguments such as progress callbacks do not affect the text, so they stay out of the key
+        key_args = [str(value) for name, value in bound.arguments.items()
+                    if signature.parameters[name].kind is not inspect.Parameter.KEYWORD_ONLY][1:]
+        key = "_".join([f"v{PDF_TEXT_CACHE_VERSION}", digest] + key_args)
+        cache_file = os.path.join(PDF_TEXT_CACHE_DIR, f"{key}.txt")
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                return f.read()
+        text = extract(pdf_path, *args, **kwargs)
+        if not text.startswith("Error extracting text from PDF") and not isinstance(text, PartialPdfText):
+            os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+            # Write beside the cache file and rename it into place, so an interrupted run never leaves a truncated entry
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=PDF_TEXT_CACHE_DIR, suffix='.tmp', delete=False) as f:
+                f.write(text)
+            os.replace(f.name, cache_file)
+        return text
+
+    return wrapper
+
+@disk_cache
+def extract_pdf_text(pdf_path, *, on_page=None):
+    """Extract text from a PDF using PyMuPDF, with OCR as a fallback for pages without text."""
+    try:
+        parts = []
+        for page_num, page_text in iter_pdf_pages(pdf_path):
+            parts.append(page_text)
+            if on_page:
+                on_page(page_num, page_text)
+        text = "\n".join(parts)
+        if not text.strip():
+            text = "No text extracted via OCR."
+        if any(isinstance(part, PartialPdfText) for part in parts):
+            text = PartialPdfText(text)
+        return text
     except Exception as e:
         return f"Error extracting text from PDF: {str(e)}"
 
 # Step 3: Chunk text for processing
+# Once a chunk is half full, a line whose CRC-32 has these low bits clear ends it (about 1 line in 32).
+# Boundaries follow the content, so an edit early in the text does not shift every later chunk.
+CHUNK_BOUNDARY_MASK = 31
+
 def chunk_text(text, max_chars=5000):
-    """Split text into smaller chunks to handle token limits."""
-    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+    """Split text into chunks to handle token limits, cutting at content-defined line boundaries."""
+    chunks = []
+    current = []
+    size = 0
+    for text_line in text.splitlines(keepends=True):
+        for line in (text_line[i:i + max_chars] for i in range(0, len(text_line), max_chars)):
+            if current and size + len(line) > max_chars:
+                chunks.append("".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line)
+            if size >= max_chars // 2 and zlib.crc32(line.encode('utf-8')) & CHUNK_BOUNDARY_MASK == 0:
+                chunks.append("".join(current))
+                current, size = [], 0
+    if current:
+        chunks.append("".join(current))
+    return chunks
 
 # Step 4: Validate PDF file
 def validate_pdf(pdf_path):
@@ -62,77 +266,102 @@ def validate_pdf(pdf_path):
         sys.exit(1)
     return True
 
-# Step 5: Estimate LaTeX word count
-def estimate_latex_word_count(latex_file):
-    """Estimate word count of a LaTeX file by stripping commands."""
-    try:
-        with open(latex_file, 'r', encoding='utf-8') as f:
-            text = f.read()
-        clean_text = re.sub(r'\\[^ ]+{.*?}|\\[a-zA-Z]+|\{|\}', '', text)
-        words = len(clean_text.split())
-        return words
-    except Exception as e:
-        print(f"Error estimating word count: {str(e)}")
-        return 0
+# Step 5: Count LaTeX words
+# LaTeX commands, command arguments and braces dropped before counting words
+_LATEX_STRIP_RE = re.compile(r'\\[^ ]+\{.*?\}|\\[a-zA-Z]+|[{}]')
+
+def count_latex_words(text):
+    """Count words in a line (or other short span) of LaTeX source."""
+    # Callers pass one line at a time, so the stripped copy and split list stay line-sized;
+    # str.split() measured ~2x faster here than counting regex matches
+    return len(_LATEX_STRIP_RE.sub('', text).split())
 
 # Step 6: Trim LaTeX content
+def scan_latex_lines(f):
+    """Count words in a LaTeX file opened in binary mode and record the byte offset of each line."""
+    word_count = 0
+    line_offsets = []
+    offset = 0
+    for line in f:
+        line_offsets.append(offset)
+        offset += len(line)
+        word_count += count_latex_words(line.decode('utf-8'))
+    return word_count, line_offsets
+
 def trim_latex_content(latex_file, max_words=6000):
     """Trim LaTeX content to approximate max word count."""
-    word_count = estimate_latex_word_count(latex_file)
-    if word_count <= max_words:
-        return
     try:
-        with open(latex_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        trimmed_lines = lines[:int(len(lines) * (max_words / word_count))]
-        with open(latex_file, 'w', encoding='utf-8') as f:
-            f.writelines(trimmed_lines)
+        with open(latex_file, 'r+b') as f:
+            word_count, line_offsets = scan_latex_lines(f)
+            if word_count <= max_words:
+                return
+            f.truncate(line_offsets[int(len(line_offsets) * (max_words / word_count))])
         print(f"Trimmed {latex_file} to approximate {max_words} words.")
     except Exception as e:
         print(f"Error trimming LaTeX file: {str(e)}")
 
 # Step 7: Define Agents
-metadata_agent = Agent(
-    role="PDF Metadata Extractor",
-    goal="Extract title, authors, and abstract/summary from a CLSI guideline PDF and format as JSON.",
-    backstory="You are an expert in parsing CLSI guideline PDFs to extract structured metadata, including titles, authors, and abstracts, with a focus on handling variable document formats.",
-    llm=llm,
-    verbose=True,
-    allow_delegation=False
-)
-
-protocol_agent = Agent(
-    role="CLSI Protocol Generator",
-    goal="Generate a concise LaTeX protocol based on the content of any CLSI guideline, tailored to its specific procedures, aiming for 1500–2000 words with examples and citations.",
-    backstory="You are a specialist in clinical laboratory standards, adept at interpreting CLSI guidelines and creating practical protocols with relevant examples and cited sources for laboratory use.",
-    llm=llm,
-    verbose=True,
-    allow_delegation=False
-)
-
-qa_agent = Agent(
-    role="Protocol Quality Assurance Specialist",
-    goal="Review extracted metadata and generated protocol for accuracy, consistency, and adherence to CLSI standards, ensuring examples and citations are relevant.",
-    backstory="You are an expert in quality control for clinical laboratory documentation, ensuring metadata accuracy, protocol completeness, and proper use of examples and citations.",
-    llm=llm,
-    verbose=True,
-    allow_delegation=False
-)
-
-enrichment_agent = Agent(
-    role="Protocol Content Enhancer",
-    goal="Enhance the protocol with concise background, examples, references, and citations to meet a 3000–4000 word target.",
-    backstory="You are a specialist in scientific writing, skilled at enriching laboratory protocols with clear examples, cited sources, and concise explanations while maintaining practicality.",
-    llm=llm,
-    verbose=True,
-    allow_delegation=False
-)
-
-# Step 8: Function to Create Tasks
-def create_tasks(pdf_text, guideline_code):
-    """Create tasks for metadata extraction, protocol generation, quality assurance, and content enrichment."""
+@functools.lru_cache(maxsize=None)
+def define_agents():
+    """Define the agents once, importing CrewAI and configuring the Gemini LLM on first use."""
+    from crewai import Agent
+    try:
+        llm = create_llm()
+    except Exception as e:
+        print(f"Error initializing Gemini LLM: {str(e)}")
+        sys.exit(1)
+
+    metadata_agent = Agent(
+        role="PDF Metadata Extractor",
+        goal="Extract title, authors, and abstract/summary from a CLSI guideline PDF and format as JSON.",
+        backstory="You are an expert in parsing CLSI guideline PDFs to extract structured metadata, including titles, authors, and abstracts, with a focus on handling variable document formats.",
+        llm=llm,
+        verbose=True,
+        allow_delegation=False
+    )
+
+    protocol_agent = Agent(
+        role="CLSI Protocol Generator",
+        goal="Generate a concise LaTeX protocol based on the content of any CLSI guideline, tailored to its specific procedures, aiming for 1500–2000 words with examples and citations.",
+        backstory="You are a specialist in clinical laboratory standards, adept at interpreting CLSI guidelines and creating practical protocols with relevant examples and cited sources for laboratory use.",
+        llm=llm,
+        verbose=True,
+        allow_delegation=False
+    )
+
+    qa_agent = Agent(
+        role="Protocol Quality Assurance Specialist",
+        goal="Review extracted metadata and generated protocol for accuracy, consistency, and adherence to CLSI standards, ensuring examples and citations are relevant.",
+        backstory="You are an expert in quality control for clinical laboratory documentation, ensuring metadata accuracy, protocol completeness, and proper use of examples and citations.",
+        llm=llm,
+        verbose=True,
+        allow_delegation=False
+    )
+
+    enrichment_agent = Agent(
+        role="Protocol Content Enhancer",
+        goal="Enhance the protocol with concise background, examples, references, and citations to meet a 3000–4000 word target.",
+        backstory="You are a specialist in scientific writing, skilled at enriching laboratory protocols with clear examples, cited sources, and concise explanations while maintaining practicality.",
+        llm=llm,
+        verbose=True,
+        allow_delegation=False
+    )
+
+    # Every agent counts against the same per-minute budget, whichever crew it runs in
+    for agent in (metadata_agent, protocol_agent, qa_agent, enrichment_agent):
+        agent.set_rpm_controller(gemini_rpm_controller())
+
+    return SimpleNamespace(metadata=metadata_agent, protocol=protocol_agent, qa=qa_agent, enrichment=enrichment_agent)
+
+# Step 8: Functions to Create Tasks
+# The metadata task only reads the start of the guideline, so it can run before extraction finishes
+METADATA_TEXT_CHARS = 200000
+
+def create_metadata_task(pdf_text, guideline_code):
+    """Create the metadata extraction task from the start of the guideline text."""
+    from crewai import Task
     # Task 1: Extract metadata
-    metadata_task = Task(
+    return Task(
         description=f"""
         Extract the title, authors, and abstract (or summary if abstract is not present) from the provided CLSI guideline text.
         Format the output as a JSON object with keys 'title', 'authors', and 'abstract'.
@@ -143,13 +372,20 @@ def create_tasks(pdf_text, guideline_code):
         - Abstract: A summary paragraph, often labeled 'Abstract', 'Summary', or 'Introduction'.
         Process the first 200,000 characters to focus on metadata.
         Text:
-        {pdf_text[:200000]}
+        {pdf_text[:METADATA_TEXT_CHARS]}
         """,
         expected_output="A JSON object with 'title', 'authors', and 'abstract' from the CLSI guideline.",
-        agent=metadata_agent,
+        agent=define_agents().metadata,
         output_file='metadata.json'
     )
 
+def create_tasks(pdf_text, guideline_code, metadata_task):
+    """Create tasks for protocol generation, quality assurance, and content enrichment."""
+    from crewai import Task
+    agents = define_agents()
+    # Chunk the guideline once; the protocol, QA and enrichment tasks share the same block
+    chunk_block = "\n\n".join(f"Chunk {i+1}:\n{chunk}" for i, chunk in enumerate(chunk_text(pdf_text[:200000])))
+
     # Task 2: Generate initial protocol
     protocol_task = Task(
         description=f"""
@@ -177,7 +413,7 @@ def create_tasks(pdf_text, guideline_code):
         - Create a clear, organized protocol, mirroring CLSI style, with concise sections, numbered steps, and cited examples.
         Process the text in chunks, prioritizing sections relevant to the guideline’s procedures.
         Text (in chunks):
-        {"".join([f"\n\nChunk {i+1}:\n{chunk}" for i, chunk in enumerate(chunk_text(pdf_text[:200000]))])}
+        {chunk_block}
         """,
         expected_output=f"""
         A LaTeX document (~1500–2000 words) containing a protocol for CLSI guideline {guideline_code}, formatted for Overleaf. The document must:
@@ -203,7 +439,7 @@ def create_tasks(pdf_text, guideline_code):
         - Use valid LaTeX syntax with minimal markup.
         - Be structured for laboratory use, ready for enrichment.
         """,
-        agent=protocol_agent,
+        agent=agents.protocol,
         output_file=f'protocol_initial_{guideline_code}.tex'
     )
 
@@ -227,13 +463,16 @@ def create_tasks(pdf_text, guideline_code):
         - 'metadata_corrections': Suggested changes to metadata (or 'None').
         - 'protocol_feedback': Feedback on protocol quality, examples, citations, and revisions.
         Input:
-        - Metadata: {json.dumps(json.load(open('metadata.json', 'r', encoding='utf-8')) if os.path.exists('metadata.json') else {})}
-        - Protocol: Content of protocol_initial_{guideline_code}.tex
+        - Metadata: The metadata extraction result, provided in the context below
+        - Protocol: The initial protocol (protocol_initial_{guideline_code}.tex), provided in the context below
         - Guideline text (in chunks):
-        {"".join([f"\n\nChunk {i+1}:\n{chunk}" for i, chunk in enumerate(chunk_text(pdf_text[:200000]))])}
+        {chunk_block}
         """,
         expected_output="A JSON object with 'metadata_corrections' and 'protocol_feedback' detailing any issues and suggested revisions.",
-        agent=qa_agent,
+        agent=agents.qa,
+        # Upstream results arrive through context; metadata.json and the .tex file are not written yet
+        # when this task is constructed
+        context=[metadata_task, protocol_task],
         output_file=f'qa_report_{guideline_code}.json'
     )
 
@@ -267,10 +506,10 @@ def create_tasks(pdf_text, guideline_code):
           \\end{{document}}
         - Ensure the document is clear, practical, and suitable for laboratory use, ready for Overleaf or Google Docs.
         Input:
-        - Initial protocol: Content of protocol_initial_{guideline_code}.tex
-        - QA report: {json.dumps(json.load(open(f'qa_report_{guideline_code}.json', 'r', encoding='utf-8')) if os.path.exists(f'qa_report_{guideline_code}.json') else {})}
+        - Initial protocol: The initial protocol (protocol_initial_{guideline_code}.tex), provided in the context below
+        - QA report: The QA report (qa_report_{guideline_code}.json), provided in the context below
         - Guideline text (in chunks):
-        {"".join([f"\n\nChunk {i+1}:\n{chunk}" for i, chunk in enumerate(chunk_text(pdf_text[:200000]))])}
+        {chunk_block}
         """,
         expected_output=f"""
         A LaTeX document (~4000–5000 words) containing an enhanced protocol for CLSI guideline {guideline_code}, formatted for Overleaf. The document must:
@@ -299,13 +538,76 @@ def create_tasks(pdf_text, guideline_code):
         - Use valid LaTeX syntax with minimal markup.
         - Be clear, practical, and ready for laboratory use or copying into a Google Doc.
         """,
-        agent=enrichment_agent,
+        agent=agents.enrichment,
+        context=[protocol_task, qa_task],
         output_file=f'protocol_{guideline_code}.tex'
     )
 
-    return [metadata_task, protocol_task, qa_task, enrichment_task]
+    return [protocol_task, qa_task, enrichment_task]
 
 # Step 9: Main Function to Process Any CLSI Guideline
+async def start_metadata_during_extraction(pdf_path, guideline_code):
+    """Start extracting the guideline text and launch the metadata crew once its first pages are in."""
+    from crewai import Crew
+    loop = asyncio.get_running_loop()
+    metadata_text = loop.create_future()
+    parts = []
+    size = 0
+
+    def publish_metadata_text(text):
+        if not metadata_text.done():
+            metadata_text.set_result(text)
+
+    def on_page(page_num, page_text):
+        # Called from the extraction thread; hand the prefix to the event loop once it is long enough
+        nonlocal size
+        parts.append(page_text)
+        size += len(page_text) + 1
+        if size >= METADATA_TEXT_CHARS and size - len(page_text) - 1 < METADATA_TEXT_CHARS:
+            loop.call_soon_threadsafe(publish_metadata_text, "\n".join(parts))
+
+    # A cache hit or a short document finishes extraction before the prefix is published
+    extraction = asyncio.create_task(asyncio.to_thread(extract_pdf_text, pdf_path, on_page=on_page))
+    await asyncio.wait([metadata_text, extraction], return_when=asyncio.FIRST_COMPLETED)
+    text = metadata_text.result() if metadata_text.done() else extraction.result()
+    metadata_task = create_metadata_task(text, guideline_code)
+    metadata_crew = Crew(
+        agents=[metadata_task.agent],
+        tasks=[metadata_task],
+        verbose=True
+    )
+    metadata_run = asyncio.create_task(metadata_crew.kickoff_async())
+    return metadata_task, metadata_run, extraction
+
+async def run_crews(pdf_path, guideline_code):
+    """Run the metadata and protocol crews in parallel, then QA and enrichment, which need both."""
+    from crewai import Crew
+    metadata_task, metadata_run, extraction = await start_metadata_during_extraction(pdf_path, guideline_code)
+    pdf_text = await extraction
+    #if "Error" in pdf_text or not pdf_text.strip():
+    #    print(pdf_text if "Error" in pdf_text else "No text extracted from PDF.")
+    #    sys.exit(1)
+
+    # Create tasks
+    protocol_task, qa_task, enrichment_task = create_tasks(pdf_text, guideline_code, metadata_task)
+
+    # The protocol only needs the guideline text, so it runs alongside the metadata crew
+    protocol_crew = Crew(
+        agents=[protocol_task.agent],
+        tasks=[protocol_task],
+        verbose=True
+    )
+    await asyncio.gather(metadata_run, protocol_crew.kickoff_async())
+
+    # QA reads the metadata and protocol, enrichment reads the protocol and QA report
+    review_crew = Crew(
+        agents=[qa_task.agent, enrichment_task.agent],
+        tasks=[qa_task, enrichment_task],
+        verbose=True
+    )
+    results = await review_crew.kickoff_async()
+    return metadata_task, results
+
 def process_clsi_guideline(pdf_path):
     """Process a CLSI guideline PDF to extract metadata and generate an enhanced protocol."""
     # Validate PDF
@@ -314,31 +616,21 @@ def process_clsi_guideline(pdf_path):
     # Extract guideline code from filename
     guideline_code = os.path.splitext(os.path.basename(pdf_path))[0]
     
-    # Extract text
     print(f"Extracting text from {pdf_path}...")
-    pdf_text = extract_pdf_text(pdf_path)
-    #if "Error" in pdf_text or not pdf_text.strip():
-    #    print(pdf_text if "Error" in pdf_text else "No text extracted from PDF.")
-    #    sys.exit(1)
-    
-    # Create tasks
-    tasks = create_tasks(pdf_text, guideline_code)
-    
-    # Create and run Crew
-    crew = Crew(
-        agents=[metadata_agent, protocol_agent, qa_agent, enrichment_agent],
-        tasks=tasks,
-        verbose=True
-    )
-    
-    # Execute tasks
     print(f"Processing CLSI guideline {guideline_code}...")
     try:
-        results = crew.kickoff()
+        # Extract text and execute tasks, running independent crews concurrently
+        try:
+            metadata_task, results = asyncio.run(run_crews(pdf_path, guideline_code))
+        finally:
+            # The shared RPM counter resets on a timer thread, which would otherwise keep the process alive;
+            # it only exists once the agents have been built
+            if gemini_rpm_controller.cache_info().currsize:
+                gemini_rpm_controller().stop_rpm_counter()
         
         # Process metadata task result
         try:
-            metadata = json.loads(str(results.tasks_output[0].raw))
+            metadata = json.loads(str(metadata_task.output.raw))
             print("\nExtracted Metadata (JSON):")
             print(json.dumps(metadata, indent=2))
             with open('metadata.json', 'w', encoding='utf-8') as f:
@@ -346,9 +638,9 @@ def process_clsi_guideline(pdf_path):
             print("Metadata saved to metadata.json")
         except json.JSONDecodeError:
             print("\nMetadata output is not valid JSON. Raw result:")
-            print(results.tasks_output[0].raw)
+            print(metadata_task.output.raw)
             with open('metadata.json', 'w', encoding='utf-8') as f:
-                f.write(str(results.tasks_output[0].raw))
+                f.write(str(metadata_task.output.raw))
             print("Raw metadata saved to metadata.json")
         
         # Process QA report